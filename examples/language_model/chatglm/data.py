@@ -12,9 +12,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
 import json
+import os
+from dataclasses import dataclass
 
 import numpy as np
+import paddle
+
+from paddlenlp.data import DataCollatorForSeq2Seq
+from paddlenlp.datasets import MapDataset
+from paddlenlp.transformers.tokenizer_utils_base import PaddingStrategy
 
 
 def read_local_dataset(path):
@@ -23,6 +31,13 @@ def read_local_dataset(path):
             yield json.loads(line.strip())
 
 
+def _build_attention_mask(input_ids, context_length):
+    attention_mask = np.tri(len(input_ids), len(input_ids))
+    attention_mask[:, :context_length] = 1
+    attention_mask = attention_mask[None, :, :]
+    return (attention_mask < 0.5).astype("int64")
+
+
 def convert_example(example, tokenizer, data_args, is_test=True):
 
     if "content" in example:
@@ -70,11 +85,7 @@ def convert_example(example, tokenizer, data_args, is_test=True):
 
         context_length = input_ids.index(tokenizer.bos_token_id)
         mask_position = context_length - 1
-
-        attention_mask = np.tri(len(input_ids), len(input_ids))
-        attention_mask[:, :context_length] = 1
-        attention_mask = attention_mask[None, :, :]
-        attention_mask = (attention_mask < 0.5).astype("int64")
+        attention_mask = _build_attention_mask(input_ids, context_length)
 
         labels = [-100] * context_length + input_ids[mask_position + 1 :]
 
@@ -129,11 +140,7 @@ def custom_instruction_convert_example(example, tokenizer, data_args, is_test=Tr
 
         context_length = input_ids.index(tokenizer.bos_token_id)
         mask_position = context_length - 1
-
-        attention_mask = np.tri(len(input_ids), len(input_ids))
-        attention_mask[:, :context_length] = 1
-        attention_mask = attention_mask[None, :, :]
-        attention_mask = (attention_mask < 0.5).astype("int64")
+        attention_mask = _build_attention_mask(input_ids, context_length)
 
         labels = [-100] * context_length + input_ids[mask_position + 1 :]
 
@@ -143,3 +150,241 @@ def custom_instruction_convert_example(example, tokenizer, data_args, is_test=Tr
             "labels": labels,
         }
     return inputs
+
+
+def _build_position_ids(input_ids, context_length, mask_position=None):
+    position_ids = np.arange(len(input_ids), dtype="int64")
+    if mask_position is not None:
+        position_ids[context_length:] = mask_position
+    block_position_ids = np.concatenate(
+        [
+            np.zeros(context_length, dtype="int64"),
+            np.arange(1, len(input_ids) - context_length + 1, dtype="int64"),
+        ]
+    )
+    return np.stack([position_ids, block_position_ids], axis=0)
+
+
+def _build_segment_inputs(segment_ids, bos_token_id):
+    context_length = segment_ids.index(bos_token_id)
+    attention_mask = _build_attention_mask(segment_ids, context_length)[0]
+    position_ids = _build_position_ids(segment_ids, context_length, mask_position=context_length - 1)
+    return attention_mask, position_ids
+
+
+def _merge_segments(segments):
+    input_ids, labels = [], []
+    for segment in segments:
+        input_ids += segment["input_ids"]
+        labels += segment["labels"]
+    return {
+        "input_ids": input_ids,
+        "labels": labels,
+        "segment_lengths": [len(segment["input_ids"]) for segment in segments],
+    }
+
+
+def _next_fit_boundaries(lengths, max_length):
+    # Indices of the first example of every packed sequence, followed by the number of examples.
+    boundaries, packed_length = [], 0
+    for i, length in enumerate(lengths):
+        if not boundaries or packed_length + length > max_length:
+            boundaries.append(i)
+            packed_length = 0
+        packed_length += length
+    return boundaries + [len(lengths)]
+
+
+def pack_sequences(dataset, max_length):
+    """
+    Concatenate the training examples into sequences of at most `max_length` tokens with next-fit
+    packing: a packed sequence is closed as soon as the next example does not fit into it. Packed
+    examples only keep `input_ids`, `labels` and the lengths of their segments, the block-diagonal
+    attention mask and the per-segment position ids are built by `ChatGLMDataCollatorForSeq2Seq`.
+    Every example is tokenized once here to read its length, even if `dataset` is mapped lazily,
+    except for a `TokenizedCache`, whose lengths are read from its offsets.
+    """
+    if isinstance(getattr(dataset, "new_data", None), TokenizedCache):
+        return MapDataset(PackedTokenizedCache(dataset.new_data, max_length))
+
+    examples = [{"input_ids": example["input_ids"], "labels": example["labels"]} for example in dataset]
+    boundaries = _next_fit_boundaries([len(example["input_ids"]) for example in examples], max_length)
+    return MapDataset([_merge_segments(examples[first:last]) for first, last in zip(boundaries[:-1], boundaries[1:])])
+
+
+class TokenizedCache:
+    """
+    Memory-mapped training features saved by `save_tokenized_cache`. The `input_ids` and `labels`
+    of all examples are stored as one `[2, num_tokens]` array with an offsets index, and the
+    attention mask is rebuilt from `input_ids` when an example is fetched.
+    """
+
+    def __init__(self, cache_path, bos_token_id):
+        self.ids = np.load(cache_path + ".ids.npy", mmap_mode="r")
+        self.offsets = np.load(cache_path + ".index.npy")
+        self.bos_token_id = bos_token_id
+
+    def __getitem__(self, idx):
+        start, end = self.offsets[idx], self.offsets[idx + 1]
+        input_ids = self.ids[0, start:end].tolist()
+        context_length = input_ids.index(self.bos_token_id)
+        return {
+            "input_ids": input_ids,
+            "attention_mask": _build_attention_mask(input_ids, context_length),
+            "labels": self.ids[1, start:end].tolist(),
+        }
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+
+class PackedTokenizedCache:
+    """
+    The packed examples of `pack_sequences` over a `TokenizedCache`. Example lengths are taken from
+    the cache offsets, and every packed sequence is sliced out of the memory map when it is fetched.
+    """
+
+    def __init__(self, cache, max_length):
+        self.cache = cache
+        self.boundaries = np.array(_next_fit_boundaries(np.diff(cache.offsets).tolist(), max_length), dtype="int64")
+
+    def __getitem__(self, idx):
+        offsets = self.cache.offsets[self.boundaries[idx] : self.boundaries[idx + 1] + 1]
+        start, end = offsets[0], offsets[-1]
+        return {
+            "input_ids": self.cache.ids[0, start:end].tolist(),
+            "labels": self.cache.ids[1, start:end].tolist(),
+            "segment_lengths": np.diff(offsets).tolist(),
+        }
+
+    def __len__(self):
+        return len(self.boundaries) - 1
+
+
+def get_tokenized_cache_path(cache_dir, data_path, **config):
+    """
+    Returns the path prefix of the tokenized cache of `data_path`. The key covers the tokenization
+    config and the modification time of `data_path`, so a changed dataset is tokenized again.
+    """
+    key = {"data_path": data_path, **config}
+    if os.path.exists(data_path):
+        key["data_path"] = os.path.abspath(data_path)
+        key["mtime"] = os.path.getmtime(data_path)
+    digest = hashlib.md5(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()
+    return os.path.join(cache_dir, digest)
+
+
+def save_tokenized_cache(dataset, cache_path):
+    input_ids, labels = [], []
+    for example in dataset:
+        input_ids.append(np.asarray(example["input_ids"], dtype="int64"))
+        labels.append(np.asarray(example["labels"], dtype="int64"))
+    offsets = np.zeros(len(input_ids) + 1, dtype="int64")
+    np.cumsum([len(ids) for ids in input_ids], out=offsets[1:])
+
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    # Write to temporary files first, so that a concurrent reader never sees a partial cache.
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    ids = np.lib.format.open_memmap(tmp_path + ".ids.npy", mode="w+", dtype="int64", shape=(2, offsets[-1]))
+    if input_ids:
+        np.concatenate(input_ids, out=ids[0])
+        np.concatenate(labels, out=ids[1])
+    ids.flush()
+    del ids
+    np.save(tmp_path + ".index.npy", offsets)
+    # `load_tokenized_cache` checks the ids file, so it is moved into place last.
+    os.replace(tmp_path + ".index.npy", cache_path + ".index.npy")
+    os.replace(tmp_path + ".ids.npy", cache_path + ".ids.npy")
+
+
+def load_tokenized_cache(cache_path, tokenizer):
+    if not os.path.exists(cache_path + ".ids.npy"):
+        return None
+    return MapDataset(TokenizedCache(cache_path, tokenizer.bos_token_id))
+
+
+_PREALLOCATED_KEYS = {"input_ids", "attention_mask", "position_ids", "labels", "segment_lengths"}
+
+
+@dataclass
+class ChatGLMDataCollatorForSeq2Seq(DataCollatorForSeq2Seq):
+    """
+    `DataCollatorForSeq2Seq` which left pads ChatGLM training features by writing them into
+    preallocated batch arrays, instead of deep copying and padding the `[1, seq_len, seq_len]`
+    attention mask of every example one by one. It also accepts the packed examples of
+    `pack_sequences`, whose block-diagonal attention mask and position ids restarting at every
+    segment are only built here. Other features, e.g. those of generation evaluation whose labels
+    are not aligned with `input_ids`, are handled by `DataCollatorForSeq2Seq`.
+    """
+
+    def _can_preallocate(self, features, return_tensors):
+        if self.padding not in (True, "longest", PaddingStrategy.LONGEST) or return_tensors != "pd":
+            return False
+        for feature in features:
+            if "labels" not in feature or not feature.keys() <= _PREALLOCATED_KEYS:
+                return False
+            if "attention_mask" not in feature and "segment_lengths" not in feature:
+                return False
+            if len(feature["labels"]) != len(feature["input_ids"]):
+                return False
+        return True
+
+    def _get_position_ids(self, input_ids):
+        # Same as the position ids built by `ChatGLMTokenizer._pad`.
+        if self.tokenizer.bos_token_id in input_ids:
+            context_length = input_ids.index(self.tokenizer.bos_token_id)
+        else:
+            context_length = len(input_ids)
+        if self.tokenizer.mask_token_id in input_ids:
+            mask_token = self.tokenizer.mask_token_id
+        else:
+            mask_token = self.tokenizer.gmask_token_id
+        mask_position = input_ids.index(mask_token) if mask_token in input_ids else None
+        return _build_position_ids(input_ids, context_length, mask_position)
+
+    def __call__(self, features, return_tensors=None):
+        if return_tensors is None:
+            return_tensors = self.return_tensors
+        if not self._can_preallocate(features, return_tensors):
+            return super().__call__(features, return_tensors=return_tensors)
+
+        batch_size = len(features)
+        seq_length = max(len(feature["input_ids"]) for feature in features)
+        if self.pad_to_multiple_of is not None:
+            seq_length = (
+                (seq_length + self.pad_to_multiple_of - 1) // self.pad_to_multiple_of * self.pad_to_multiple_of
+            )
+
+        input_ids = np.full((batch_size, seq_length), self.tokenizer.pad_token_id, dtype="int64")
+        labels = np.full((batch_size, seq_length), self.label_pad_token_id, dtype="int64")
+        # 1 marks the masked positions, so padding and tokens of different segments can not be attended to.
+        attention_mask = np.ones((batch_size, 1, seq_length, seq_length), dtype="int64")
+        position_ids = np.zeros((batch_size, 2, seq_length), dtype="int64")
+        for i, feature in enumerate(features):
+            offset = seq_length - len(feature["input_ids"])
+            input_ids[i, offset:] = feature["input_ids"]
+            labels[i, offset:] = feature["labels"]
+            if "segment_lengths" in feature:
+                start = 0
+                for segment_length in feature["segment_lengths"]:
+                    end = start + segment_length
+                    segment_ids = list(feature["input_ids"][start:end])
+                    segment_mask, segment_position_ids = _build_segment_inputs(
+                        segment_ids, self.tokenizer.bos_token_id
+                    )
+                    attention_mask[i, 0, offset + start : offset + end, offset + start : offset + end] = segment_mask
+                    position_ids[i, :, offset + start : offset + end] = segment_position_ids
+                    start = end
+                continue
+            attention_mask[i, :, offset:, offset:] = feature["attention_mask"]
+            if "position_ids" in feature:
+                position_ids[i, :, offset:] = feature["position_ids"]
+            else:
+                position_ids[i, :, offset:] = self._get_position_ids(list(feature["input_ids"]))
+
+        return {
+            "input_ids": paddle.to_tensor(input_ids),
+            "attention_mask": paddle.to_tensor(attention_mask),
+            "position_ids": paddle.to_tensor(position_ids),
+            "labels": paddle.to_tensor(labels),
+        }
@@ -14,15 +14,22 @@
 
 import os
 from dataclasses import dataclass, field
-from functools import partial
+from functools import lru_cache, partial
 
 import numpy as np
 import paddle
-from data import convert_example, custom_instruction_convert_example, read_local_dataset
-from sklearn.metrics import accuracy_score
+from data import (
+    ChatGLMDataCollatorForSeq2Seq,
+    convert_example,
+    custom_instruction_convert_example,
+    get_tokenized_cache_path,
+    load_tokenized_cache,
+    pack_sequences,
+    read_local_dataset,
+    save_tokenized_cache,
+)
 from utils import ChatGLMTrainer, save_infer_result
 
-from paddlenlp.data import DataCollatorForSeq2Seq
 from paddlenlp.datasets import load_dataset
 from paddlenlp.metrics import BLEU, Rouge1, Rouge2, RougeL
 from paddlenlp.peft import LoRAConfig, LoRAModel, PrefixConfig, PrefixModelForCausalLM
@@ -34,6 +41,28 @@ from paddlenlp.trainer import PdArgumentParser, TrainingArguments, get_last_chec
 from paddlenlp.transformers import ChatGLMForConditionalGeneration, ChatGLMTokenizer
 from paddlenlp.utils.log import logger
 
+# Rouge1/Rouge2 keep no state across `score` calls, so they can be shared by every evaluation.
+ROUGE1 = Rouge1()
+ROUGE2 = Rouge2()
+
+
+def _strip_ignore_index(batch_ids, ignore_index=-100):
+    """Removes `ignore_index` from each row of the padded 2D `batch_ids` and returns the rows as lists."""
+    batch_ids = np.asarray(batch_ids)
+    mask = batch_ids != ignore_index
+    offsets = np.cumsum(np.count_nonzero(mask, axis=-1))[:-1]
+    return [ids.tolist() for ids in np.split(batch_ids[mask], offsets)]
+
+
+def _flatten(arrays):
+    """Flattens an array or a sequence of arrays into one 1D array with as few copies as possible."""
+    if isinstance(arrays, np.ndarray):
+        return arrays.ravel()
+    arrays = [np.asarray(array) for array in arrays]
+    if all(array.shape == arrays[0].shape for array in arrays):
+        return np.stack(arrays).ravel()
+    return np.concatenate([array.ravel() for array in arrays])
+
 
 @dataclass
 class DataArgument:
@@ -42,6 +71,19 @@ class DataArgument:
     tgt_length: int = field(default=180, metadata={"help": "The max length of target text."})
     num_beams: int = field(default=5, metadata={"help": "The number of beams."})
     generate_num: int = field(default=0, metadata={"help": "Save first k examples generation result in dev dataset"})
+    preprocessing_num_workers: int = field(
+        default=0,
+        metadata={
+            "help": "The number of processes used to tokenize the training dataset up front. Values <= 1 keep the "
+            "default lazy tokenization. Note the eager features include a dense attention mask for every example."
+        },
+    )
+    pack_sequences: bool = field(
+        default=False, metadata={"help": "Whether to pack several training examples into one sequence."}
+    )
+    tokenized_cache_dir: str = field(
+        default=None, metadata={"help": "The directory to cache the tokenized training dataset, None to disable."}
+    )
 
 
 @dataclass
@@ -65,8 +107,9 @@ def main():
     parser = PdArgumentParser((ModelArgument, DataArgument, TrainingArguments))
     model_args, data_args, training_args = parser.parse_args_into_dataclasses()
 
-    training_args.print_config(model_args, "Model")
-    training_args.print_config(data_args, "Data")
+    if training_args.should_log:
+        training_args.print_config(model_args, "Model")
+        training_args.print_config(data_args, "Data")
 
     paddle.set_device(training_args.device)
 
@@ -89,15 +132,64 @@ def main():
                 "the `--output_dir` or add `--overwrite_output_dir` to train from scratch."
             )
 
+    tokenizer = ChatGLMTokenizer.from_pretrained(model_args.model_name_or_path)
+
+    # Load the dataset.
+    train_path = os.path.join(data_args.task_name_or_path, "train.json")
+    dev_path = os.path.join(data_args.task_name_or_path, "dev.json")
+    if os.path.exists(train_path) and os.path.exists(dev_path):
+        dev_ds = load_dataset(read_local_dataset, path=dev_path, lazy=False)
+        trans_func = partial(convert_example, tokenizer=tokenizer, data_args=data_args)
+    else:
+        train_path = None
+        dev_ds = load_dataset("bellegroup", data_args.task_name_or_path, splits="dev")
+        trans_func = partial(custom_instruction_convert_example, tokenizer=tokenizer, data_args=data_args)
+
+    # Tokenize before the model is loaded, so that the worker processes are not forked with the model on the GPU.
+    def tokenize_train_dataset():
+        if train_path is not None:
+            train_ds = load_dataset(read_local_dataset, path=train_path, lazy=False)
+        else:
+            train_ds = load_dataset("bellegroup", data_args.task_name_or_path, splits="train")
+        return train_ds.map(partial(trans_func, is_test=False), num_workers=data_args.preprocessing_num_workers)
+
+    if data_args.tokenized_cache_dir is None:
+        train_ds = tokenize_train_dataset()
+    else:
+        train_cache_path = get_tokenized_cache_path(
+            data_args.tokenized_cache_dir,
+            train_path or data_args.task_name_or_path,
+            tokenizer=model_args.model_name_or_path,
+            src_length=data_args.src_length,
+            tgt_length=data_args.tgt_length,
+        )
+        # The main process of each node builds the cache, the other ranks wait and then memory-map it.
+        with training_args.main_process_first(desc="tokenize train dataset"):
+            train_ds = load_tokenized_cache(train_cache_path, tokenizer)
+            if train_ds is None:
+                save_tokenized_cache(tokenize_train_dataset(), train_cache_path)
+                train_ds = load_tokenized_cache(train_cache_path, tokenizer)
+            else:
+                logger.info(f"Loading the tokenized training dataset from {train_cache_path}")
+
+    if model_args.do_generation:
+        test_ds = dev_ds.map(trans_func)
+    else:
+        test_ds = dev_ds.map(partial(trans_func, is_test=False))
+    if data_args.pack_sequences:
+        train_ds = pack_sequences(train_ds, max_length=data_args.src_length + data_args.tgt_length)
+
     dtype = paddle.get_default_dtype()
     if training_args.fp16_opt_level == "O2":
         if training_args.fp16:
             dtype = "float16"
+        if training_args.bf16:
+            dtype = "bfloat16"
 
     # Load the pretrained language model.
     model = ChatGLMForConditionalGeneration.from_pretrained(
         model_args.model_name_or_path,
-        load_state_as_np=True,
+        low_cpu_mem_usage=True,
         dtype=dtype,
         tensor_parallel_degree=training_args.tensor_parallel_degree,
         tensor_parallel_rank=training_args.tensor_parallel_rank,
@@ -119,8 +211,15 @@ def main():
             pad_attention_mask=chatglm_pad_attention_mask,
         )
         model.mark_only_prefix_as_trainable()
-        model.print_trainable_parameters()
+        if training_args.should_log:
+            model.print_trainable_parameters()
     if model_args.lora:
+        if training_args.tensor_parallel_degree > 1:
+            logger.warning(
+                "LoRA adapters are tiny compared to the frozen backbone, the all-reduce of tensor parallel usually "
+                "dominates the cost of LoRA layers. Consider `--sharding stage3` with `--tensor_parallel_degree 1` "
+                "to shard the backbone parameters while keeping the LoRA computation local."
+            )
         if model_args.lora_all_linear:
             target_modules = [".*query_key_value.*", ".*dense.*"]
         else:
@@ -136,50 +235,35 @@ def main():
         )
         model = LoRAModel(model, lora_config)
         model.mark_only_lora_as_trainable()
-        model.print_trainable_parameters()
-    tokenizer = ChatGLMTokenizer.from_pretrained(model_args.model_name_or_path)
-
-    # Load the dataset.
-    if os.path.exists(os.path.join(data_args.task_name_or_path, "train.json")) and os.path.exists(
-        os.path.join(data_args.task_name_or_path, "dev.json")
-    ):
-        train_ds = load_dataset(
-            read_local_dataset, path=os.path.join(data_args.task_name_or_path, "train.json"), lazy=False
-        )
-        dev_ds = load_dataset(
-            read_local_dataset, path=os.path.join(data_args.task_name_or_path, "dev.json"), lazy=False
-        )
-        trans_func = partial(convert_example, tokenizer=tokenizer, data_args=data_args)
-    else:
-        train_ds, dev_ds = load_dataset("bellegroup", data_args.task_name_or_path, splits=["train", "dev"])
-        trans_func = partial(custom_instruction_convert_example, tokenizer=tokenizer, data_args=data_args)
-    if model_args.do_generation:
-        train_ds = train_ds.map(partial(trans_func, is_test=False))
-        test_ds = dev_ds.map(trans_func)
-    else:
-        train_ds = train_ds.map(partial(trans_func, is_test=False))
-        test_ds = dev_ds.map(partial(trans_func, is_test=False))
-
-    collate_fn = DataCollatorForSeq2Seq(
-        tokenizer=tokenizer, max_length=data_args.src_length + data_args.tgt_length, padding=True
+        if training_args.should_log:
+            model.print_trainable_parameters()
+    collate_fn = ChatGLMDataCollatorForSeq2Seq(
+        tokenizer=tokenizer,
+        max_length=data_args.src_length + data_args.tgt_length,
+        padding=True,
+        pad_to_multiple_of=16 if training_args.bf16 else 8,
     )
 
+    # The labels of the dev set are the same in every evaluation, so their decoded text is cached.
+    @lru_cache(maxsize=200000)
+    def decode_reference(token_ids):
+        return tokenizer.decode(list(token_ids), skip_special_tokens=True)
+
     def compute_metrics_do_generation(eval_preds):
-        rouge1 = Rouge1()
-        rouge2 = Rouge2()
         rougel = RougeL()
         bleu4 = BLEU(n_size=4)
 
-        predictions = [x[x != -100].tolist() for x in eval_preds.predictions]
-        references = [x[x != -100].tolist() for x in eval_preds.label_ids]
+        predictions = _strip_ignore_index(eval_preds.predictions)
+        references = _strip_ignore_index(eval_preds.label_ids)
         predictions = tokenizer.batch_decode(predictions, skip_special_tokens=True)
-        references = tokenizer.batch_decode(references, skip_special_tokens=True)
-        # for pred in predictions:
-        rouge1_score = rouge1.score(predictions, references)
-        rouge2_score = rouge2.score(predictions, references)
+        references = [decode_reference(tuple(ref)) for ref in references]
+        rouge1_score = ROUGE1.score(predictions, references)
+        rouge2_score = ROUGE2.score(predictions, references)
+        rougel_add_inst, bleu4_add_inst = rougel.add_inst, bleu4.add_inst
         for pred, ref in zip(predictions, references):
-            rougel.add_inst(pred, [ref])
-            bleu4.add_inst(pred, [ref])
+            ref_list = [ref]
+            rougel_add_inst(pred, ref_list)
+            bleu4_add_inst(pred, ref_list)
         return {
             "rouge1": rouge1_score,
             "rouge2": rouge2_score,
@@ -188,13 +272,12 @@ def main():
         }
 
     def compute_metrics(eval_preds):
-        flattened_preds = np.array(eval_preds.predictions).flatten()
-        flattened_labels = np.array(eval_preds.label_ids).flatten()
-        filtered_preds = flattened_preds[flattened_labels != -100]
-        filtered_labels = flattened_labels[flattened_labels != -100]
-        accuracy = accuracy_score(y_true=filtered_labels, y_pred=filtered_preds)
+        labels = _flatten(eval_preds.label_ids)
+        preds = _flatten(eval_preds.predictions)
+        mask = labels != -100
+        accuracy = np.count_nonzero(preds[mask] == labels[mask]) / max(np.count_nonzero(mask), 1)
         return {
-            "accuracy": accuracy,
+            "accuracy": float(accuracy),
         }
 
     trainer = ChatGLMTrainer(
@@ -229,5 +312,4 @@ def main():
 
 
 if __name__ == "__main__":
-    with paddle.amp.auto_cast(enable=False):
-        main()
+    main()
@@ -116,16 +116,17 @@ class ChatGLMTrainer(Trainer):
         n_token_id = self.tokenizer.convert_tokens_to_ids("<n>")
         model.eval()
         with paddle.no_grad():
-            generated_tokens = model.generate(
-                **inputs,
-                **self._gen_kwargs.copy(),
-                decode_strategy="sampling",
-                top_k=1,
-                bos_token_id=self.tokenizer.bos_token_id,
-                eos_token_id=self.tokenizer.eos_token_id,
-                pad_token_id=self.tokenizer.pad_token_id,
-                use_cache=True,
-            )[0]
+            with self.autocast_smart_context_manager():
+                generated_tokens = model.generate(
+                    **inputs,
+                    **self._gen_kwargs.copy(),
+                    decode_strategy="sampling",
+                    top_k=1,
+                    bos_token_id=self.tokenizer.bos_token_id,
+                    eos_token_id=self.tokenizer.eos_token_id,
+                    pad_token_id=self.tokenizer.pad_token_id,
+                    use_cache=True,
+                )[0]
             all_preds = []
             for pred_tokens in generated_tokens:
                 pred_tokens = pred_tokens[pred_tokens != self.tokenizer.pad_token_id]
@@ -12,8 +12,6 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import numpy as np
-
 import paddle
 from .utils import default_trans_func
 
@@ -166,14 +164,19 @@ class RougeL(paddle.metric.Metric):
         """
         if len(string) < len(sub):
             sub, string = string, sub
-        lengths = np.zeros((len(string) + 1, len(sub) + 1))
-        for j in range(1, len(sub) + 1):
-            for i in range(1, len(string) + 1):
-                if string[i - 1] == sub[j - 1]:
-                    lengths[i][j] = lengths[i - 1][j - 1] + 1
+        # Only the previous row of the dynamic programming table is needed, keep it in a plain
+        # list since indexing numpy arrays element by element is much slower in Python.
+        lengths = [0] * (len(sub) + 1)
+        for char in string:
+            prev_diag = 0
+            for j, sub_char in enumerate(sub, 1):
+                prev = lengths[j]
+                if char == sub_char:
+                    lengths[j] = prev_diag + 1
                 else:
-                    lengths[i][j] = max(lengths[i - 1][j], lengths[i][j - 1])
-        return lengths[len(string)][len(sub)]
+                    lengths[j] = max(prev, lengths[j - 1])
+                prev_diag = prev
+        return float(lengths[-1])
 
     def add_inst(self, cand, ref_list):
         """
@@ -0,0 +1,125 @@
+# Copyright (c) 2023 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import annotations
+
+import os
+import sys
+import tempfile
+from types import SimpleNamespace
+from unittest import TestCase
+
+import numpy as np
+
+from paddlenlp.data import DataCollatorForSeq2Seq
+from paddlenlp.transformers import ChatGLMTokenizer
+
+
+class ChatGLMDataTest(TestCase):
+    def setUp(self) -> None:
+        self.path = "./examples/language_model/chatglm"
+        sys.path.insert(0, self.path)
+        # other examples also ship a `data` module
+        sys.modules.pop("data", None)
+        self.tokenizer = ChatGLMTokenizer.from_pretrained("THUDM/chatglm-6b")
+        self.data_args = SimpleNamespace(src_length=16, tgt_length=16)
+
+    def tearDown(self) -> None:
+        sys.path.remove(self.path)
+        sys.modules.pop("data", None)
+
+    def get_features(self):
+        from data import convert_example
+
+        examples = [
+            {"src": "你好", "tgt": "你好，有什么可以帮你的吗？"},
+            {"src": "请写一句关于春天的诗", "tgt": "春眠不觉晓"},
+            {"content": "类型#上衣*颜色#白色*风格#简约", "summary": "简约的白色上衣，百搭又舒适。"},
+        ]
+        return [convert_example(example, self.tokenizer, self.data_args, is_test=False) for example in examples]
+
+    def test_same_as_seq2seq_collator(self):
+        from data import ChatGLMDataCollatorForSeq2Seq
+
+        features = self.get_features()
+        self.assertGreater(len({len(feature["input_ids"]) for feature in features}), 1)
+        for pad_to_multiple_of in [None, 8]:
+            batch = ChatGLMDataCollatorForSeq2Seq(
+                tokenizer=self.tokenizer, max_length=32, pad_to_multiple_of=pad_to_multiple_of
+            )(features)
+            expected = DataCollatorForSeq2Seq(
+                tokenizer=self.tokenizer, max_length=32, padding=True, pad_to_multiple_of=pad_to_multiple_of
+            )(features)
+            for key in ["input_ids", "labels", "attention_mask", "position_ids"]:
+                np.testing.assert_array_equal(batch[key].numpy(), expected[key].numpy())
+
+    def test_packed_features(self):
+        from data import ChatGLMDataCollatorForSeq2Seq, pack_sequences
+
+        features = self.get_features()[:2]
+        lengths = [len(feature["input_ids"]) for feature in features]
+        packed = pack_sequences(features, max_length=sum(lengths))
+        self.assertEqual(len(packed), 1)
+
+        collator = ChatGLMDataCollatorForSeq2Seq(tokenizer=self.tokenizer)
+        batch = collator([packed[0]])
+        attention_mask = batch["attention_mask"].numpy()[0, 0]
+        position_ids = batch["position_ids"].numpy()[0]
+
+        offset = 0
+        for feature, length in zip(features, lengths):
+            expected = collator([feature])
+            end = offset + length
+            np.testing.assert_array_equal(
+                attention_mask[offset:end, offset:end], expected["attention_mask"].numpy()[0, 0]
+            )
+            np.testing.assert_array_equal(position_ids[:, offset:end], expected["position_ids"].numpy()[0])
+            # segments can not attend to each other
+            self.assertTrue((attention_mask[offset:end, :offset] == 1).all())
+            self.assertTrue((attention_mask[offset:end, end:] == 1).all())
+            offset = end
+
+    def test_tokenized_cache(self):
+        from data import load_tokenized_cache, pack_sequences, save_tokenized_cache
+
+        features = self.get_features()
+        with tempfile.TemporaryDirectory() as tempdir:
+            cache_path = os.path.join(tempdir, "cache", "train")
+            self.assertIsNone(load_tokenized_cache(cache_path, self.tokenizer))
+            save_tokenized_cache(features, cache_path)
+            cached = load_tokenized_cache(cache_path, self.tokenizer)
+
+            self.assertEqual(len(cached), len(features))
+            for feature, cached_feature in zip(features, cached):
+                self.assertEqual(cached_feature["input_ids"], feature["input_ids"])
+                self.assertEqual(cached_feature["labels"], feature["labels"])
+                np.testing.assert_array_equal(cached_feature["attention_mask"], feature["attention_mask"])
+
+            max_length = len(features[0]["input_ids"]) + len(features[1]["input_ids"])
+            self.assertEqual(list(pack_sequences(cached, max_length)), list(pack_sequences(features, max_length)))
+
+    def test_tokenized_cache_path(self):
+        from data import get_tokenized_cache_path
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            data_path = os.path.join(tempdir, "train.json")
+            with open(data_path, "w", encoding="utf-8") as fp:
+                fp.write("{}\n")
+            cache_path = get_tokenized_cache_path(tempdir, data_path, src_length=16, tgt_length=16)
+            self.assertEqual(cache_path, get_tokenized_cache_path(tempdir, data_path, src_length=16, tgt_length=16))
+            self.assertNotEqual(cache_path, get_tokenized_cache_path(tempdir, data_path, src_length=32, tgt_length=16))
+
+            mtime = os.path.getmtime(data_path) + 10
+            os.utime(data_path, (mtime, mtime))
+            self.assertNotEqual(cache_path, get_tokenized_cache_path(tempdir, data_path, src_length=16, tgt_length=16))
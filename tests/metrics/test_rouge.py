@@ -32,3 +32,9 @@ class TestRouge(unittest.TestCase):
         ref_list = [["The", "cat", "is", "on", "the", "mat"], ["There", "is", "a", "cat", "on", "the", "mat"]]
         rougel.add_inst(cand, ref_list)
         self.assertEqual(rougel.score(), 0.7800511508951408)
+
+    def test_lcs(self):
+        rougel = RougeL()
+        self.assertEqual(rougel.lcs("ABCBDAB", "BDCABA"), 4.0)
+        self.assertEqual(rougel.lcs("BDCABA", "ABCBDAB"), 4.0)
+        self.assertEqual(rougel.lcs("abc", ""), 0.0)